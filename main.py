@@ -4,6 +4,7 @@ import random
 import sqlite3
 import json
 import sys
+import time
 from typing import List, Optional
 from datetime import datetime
 
@@ -74,57 +75,131 @@ dp.include_router(router)
 class ProfileStates(StatesGroup):
     waiting_for_profile = State()
 
-# === ИНИЦИАЛИЗАЦИЯ БД ===
-def init_db():
-    conn = sqlite3.connect("dating_bot.db")
-    cursor = conn.cursor()
-    cursor.execute("""
+# === МИГРАЦИИ БД ===
+# Версия схемы хранится в PRAGMA user_version. Миграции только добавляются в конец,
+# уже выпущенные не редактируются. Каждая применяется в своей транзакции.
+MIGRATIONS = [
+    (1, "базовые таблицы", [
+        """
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT UNIQUE,
             name TEXT,
             bio TEXT
         )
-    """)
-    cursor.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS photos (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
             file_id TEXT,
             FOREIGN KEY (user_id) REFERENCES users (user_id)
         )
-    """)
-    cursor.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS last_viewed (
             user_id INTEGER PRIMARY KEY,
             last_profile_id INTEGER
         )
-    """)
-    cursor.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS queues (
             user_id INTEGER PRIMARY KEY,
             queue TEXT,
             idx INTEGER DEFAULT 0
         )
-    """)
-    cursor.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS notifications (
             user_id INTEGER PRIMARY KEY
         )
-    """)
-    # For likes table, drop if exists to ensure correct schema
-    cursor.execute("DROP TABLE IF EXISTS likes")
-    cursor.execute("""
-        CREATE TABLE likes (
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS likes (
             viewer_id INTEGER,
             profile_id INTEGER,
             like_type TEXT CHECK (like_type IN ('like', 'dislike')),
             PRIMARY KEY (viewer_id, profile_id)
         )
-    """)
-    conn.commit()
+        """,
+    ]),
+    (2, "таблица activity", [
+        """
+        CREATE TABLE IF NOT EXISTS activity (
+            user_id INTEGER PRIMARY KEY,
+            last_seen REAL
+        )
+        """,
+    ]),
+    # Индексы по одному на миграцию — блокировка записи держится только на время одной сборки
+    (3, "индекс likes по profile_id/like_type", [
+        "CREATE INDEX IF NOT EXISTS idx_likes_profile_type ON likes (profile_id, like_type, viewer_id)",
+    ]),
+    (4, "индекс photos по user_id", [
+        "CREATE INDEX IF NOT EXISTS idx_photos_user ON photos (user_id, id, file_id)",
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Горячие запросы, которые обязаны идти по индексу (запрос, параметры)
+HOT_QUERIES = [
+    ("SELECT COUNT(*) FROM likes WHERE profile_id = ? AND like_type = ?", (0, "like")),
+    ("SELECT viewer_id FROM likes WHERE profile_id = ? AND like_type = 'like'", (0,)),
+    ("SELECT 1 FROM likes WHERE viewer_id = ? AND profile_id = ? AND like_type = 'like'", (0, 0)),
+    ("SELECT file_id FROM photos WHERE user_id = ? ORDER BY id", (0,)),
+]
+
+def migrate_db(conn: sqlite3.Connection) -> int:
+    """Применяет недостающие миграции. Возвращает итоговую версию схемы."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Схема БД v{version} новее, чем знает бот (v{SCHEMA_VERSION})")
+    for target, description, statements in MIGRATIONS:
+        if target <= version:
+            continue
+        started = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        version = target
+        logger.info(f"💾 Миграция v{target} ({description}) применена за {time.perf_counter() - started:.3f}s")
+    return version
+
+def check_query_plans(conn: sqlite3.Connection) -> List[str]:
+    """Возвращает горячие запросы, которые SQLite выполняет полным сканом таблицы."""
+    slow = []
+    for query, params in HOT_QUERIES:
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+        if any(row[-1].startswith("SCAN") for row in plan):
+            slow.append(query)
+    return slow
+
+def enable_incremental_vacuum(conn: sqlite3.Connection):
+    """Переводит файл в auto_vacuum=INCREMENTAL. Разовый полный VACUUM — только до старта поллинга."""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    started = time.perf_counter()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    logger.info(f"💾 auto_vacuum переключён на INCREMENTAL за {time.perf_counter() - started:.3f}s")
+
+def init_db():
+    conn = sqlite3.connect("dating_bot.db", isolation_level=None)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version != SCHEMA_VERSION:
+        version = migrate_db(conn)
+    enable_incremental_vacuum(conn)
+    for query in check_query_plans(conn):
+        logger.warning(f"⚠️ Запрос идёт полным сканом: {query}")
     conn.close()
-    logger.info("💾 База данных инициализирована!")
+    logger.info(f"💾 База данных готова (схема v{version})")
 
 init_db()
 
@@ -503,7 +578,7 @@ async def cmd_profile(message: Message, state: FSMContext):
     else:
         await message.answer("Отправьте вашу анкету одним сообщением (текст + фото).", reply_markup=None)
         await state.set_state(ProfileStates.waiting_for_profile)
-        await state.update_data(username=username)
+        await state.update_data(username=username, form_started_at=time.time())
         log_user_action(message.from_user, "создаёт новую анкету")
 
 @router.message(F.text == "👤 Моя анкета")
@@ -545,7 +620,7 @@ async def cb_update_profile(callback: CallbackQuery, state: FSMContext):
     log_callback(callback)
     await callback.message.edit_text("Отправьте новую анкету (текст + фото).")
     await state.set_state(ProfileStates.waiting_for_profile)
-    await state.update_data(username=callback.from_user.username)
+    await state.update_data(username=callback.from_user.username, form_started_at=time.time())
     await bot.send_message(callback.from_user.id, "\u180e", reply_markup=get_main_menu())
     await callback.answer()
 
@@ -645,12 +720,209 @@ async def cb_dislike(callback: CallbackQuery):
     await callback.answer("Дизлайк поставлен! 👎")
     log_user_action(callback.from_user, f"поставил дизлайк анкете id:{profile_id}")
 
+# === ОБСЛУЖИВАНИЕ (ПЛАНИРОВЩИК) ===
+MAINTENANCE_TICK_SECONDS = 60              # Как часто планировщик проверяет задачи
+LIVE_TRAFFIC_QUIET_SECONDS = 30            # Не трогаем БД, если были апдейты за последние N секунд
+MAINTENANCE_MAX_DELAY = 15 * 60            # Дольше этого назревшую задачу не откладываем даже при трафике
+QUEUE_COMPACT_INTERVAL = 30 * 60
+QUEUE_COMPACT_BATCH = 200                  # Очередей за одну транзакцию
+QUEUE_COMPACT_PAUSE = 0.5                  # Пауза между пачками
+QUEUE_COMPACT_BUSY_PAUSE = 5               # Пауза между пачками, пока идёт живой трафик
+IDLE_EVICT_INTERVAL = 6 * 3600
+IDLE_STATE_TTL = 30 * 24 * 3600            # Через сколько бездействия выкидываем очередь и last_viewed
+FSM_EXPIRE_INTERVAL = 15 * 60
+FSM_STATE_TTL = 24 * 3600                  # Брошенное заполнение анкеты
+DB_HOUSEKEEPING_INTERVAL = 24 * 3600
+OFFPEAK_HOURS = range(3, 6)                # ANALYZE/VACUUM только ночью (локальное время)
+INCREMENTAL_VACUUM_PAGES = 1000
+
+# Последняя активность пользователей (в памяти, сбрасывается в таблицу activity)
+user_last_seen: dict[int, float] = {}
+last_traffic_at = 0.0
+
+@dp.update.outer_middleware()
+async def track_activity(handler, event, data):
+    global last_traffic_at
+    now = time.time()
+    last_traffic_at = now
+    user = data.get("event_from_user")
+    if user:
+        user_last_seen[user.id] = now
+    return await handler(event, data)
+
+def is_traffic_live(now: float) -> bool:
+    return now - last_traffic_at < LIVE_TRAFFIC_QUIET_SECONDS
+
+def compact_user_queues(limit: int, after_user_id: int = 0) -> tuple[int, Optional[int]]:
+    """Срезает просмотренный префикс очередей. Возвращает (сжато, последний user_id пачки)."""
+    conn = sqlite3.connect("dating_bot.db")
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id, queue, idx FROM queues WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                   (after_user_id, limit))
+    rows = cursor.fetchall()
+    compacted = 0
+    for owner_id, q_json, idx in rows:
+        if not q_json or idx <= 0:
+            continue
+        queue = json.loads(q_json)
+        cursor.execute("UPDATE queues SET queue = ?, idx = 0 WHERE user_id = ?",
+                       (json.dumps(queue[idx:]), owner_id))
+        compacted += 1
+    conn.commit()
+    conn.close()
+    last_user_id = rows[-1][0] if len(rows) == limit else None
+    return compacted, last_user_id
+
+def flush_user_activity(now: float):
+    conn = sqlite3.connect("dating_bot.db")
+    cursor = conn.cursor()
+    cursor.executemany("INSERT OR REPLACE INTO activity (user_id, last_seen) VALUES (?, ?)",
+                       list(user_last_seen.items()))
+    # Тем, кого ещё не видели, засчитываем активность сейчас — отсчёт TTL начнётся с этого момента
+    cursor.execute("INSERT OR IGNORE INTO activity (user_id, last_seen) SELECT user_id, ? FROM queues", (now,))
+    cursor.execute("INSERT OR IGNORE INTO activity (user_id, last_seen) SELECT user_id, ? FROM last_viewed", (now,))
+    conn.commit()
+    conn.close()
+
+def evict_idle_users(ttl: float, now: float) -> int:
+    flush_user_activity(now)
+    cutoff = now - ttl
+    conn = sqlite3.connect("dating_bot.db")
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM queues WHERE user_id IN (SELECT user_id FROM activity WHERE last_seen < ?)", (cutoff,))
+    evicted = cursor.rowcount
+    cursor.execute("DELETE FROM last_viewed WHERE user_id IN (SELECT user_id FROM activity WHERE last_seen < ?)", (cutoff,))
+    cursor.execute("DELETE FROM activity WHERE last_seen < ?", (cutoff,))
+    conn.commit()
+    conn.close()
+    for user_id, last_seen in list(user_last_seen.items()):
+        if last_seen < cutoff:
+            del user_last_seen[user_id]
+    return evicted
+
+def expire_abandoned_states(ttl: float, now: float) -> int:
+    expired = 0
+    for key, record in list(storage.storage.items()):
+        if record.state == ProfileStates.waiting_for_profile.state:
+            # Таймаут считается от входа в форму: пока заполняют анкету, можно листать остальное меню
+            if now - record.data.get("form_started_at", 0.0) < ttl:
+                continue
+            expired += 1
+        elif record.state is None and not record.data:
+            # Пустые записи, которые MemoryStorage заводит на каждое обращение
+            if now - user_last_seen.get(key.user_id, 0.0) < ttl:
+                continue
+        else:
+            continue
+        del storage.storage[key]
+    return expired
+
+def run_db_housekeeping() -> int:
+    """ANALYZE + incremental vacuum. Возвращает число освобождённых страниц."""
+    conn = sqlite3.connect("dating_bot.db")
+    cursor = conn.cursor()
+    cursor.execute("ANALYZE")
+    cursor.execute("PRAGMA freelist_count")
+    free_before = cursor.fetchone()[0]
+    cursor.execute(f"PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES})")
+    cursor.fetchall()
+    cursor.execute("PRAGMA freelist_count")
+    free_after = cursor.fetchone()[0]
+    conn.commit()
+    conn.close()
+    return free_before - free_after
+
+async def job_compact_queues() -> str:
+    total = 0
+    after_user_id = 0
+    while True:
+        compacted, after_user_id = compact_user_queues(QUEUE_COMPACT_BATCH, after_user_id)
+        total += compacted
+        if after_user_id is None:
+            break
+        await asyncio.sleep(QUEUE_COMPACT_BUSY_PAUSE if is_traffic_live(time.time()) else QUEUE_COMPACT_PAUSE)
+    return f"сжато очередей: {total}"
+
+async def job_evict_idle() -> str:
+    return f"выкинуто неактивных: {evict_idle_users(IDLE_STATE_TTL, time.time())}"
+
+async def job_expire_fsm() -> str:
+    return f"сброшено брошенных анкет: {expire_abandoned_states(FSM_STATE_TTL, time.time())}"
+
+async def job_db_housekeeping() -> str:
+    freed = await asyncio.to_thread(run_db_housekeeping)
+    return f"ANALYZE выполнен, освобождено страниц: {freed}"
+
+class MaintenanceJob:
+    def __init__(self, name: str, func, interval: float, offpeak_only: bool = False):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.offpeak_only = offpeak_only
+        self.last_run = 0.0
+        self.due_since: Optional[float] = None
+        self.runs = 0
+        self.failures = 0
+        self.last_duration = 0.0
+        self.total_duration = 0.0
+
+    def is_due(self, now: float) -> bool:
+        if now - self.last_run < self.interval:
+            return False
+        if self.offpeak_only and datetime.fromtimestamp(now).hour not in OFFPEAK_HOURS:
+            return False
+        return True
+
+    async def run(self):
+        self.last_run = time.time()
+        self.due_since = None
+        started = time.perf_counter()
+        try:
+            result = await self.func()
+        except Exception as e:
+            self.failures += 1
+            result = None
+            logger.error(f"🔥 Ошибка задачи обслуживания [{self.name}]: {e}")
+        self.runs += 1
+        self.last_duration = time.perf_counter() - started
+        self.total_duration += self.last_duration
+        if result is not None:
+            logger.info(f"🧹 [{self.name}] {result} за {self.last_duration:.3f}s "
+                        f"(запусков: {self.runs}, ошибок: {self.failures}, всего: {self.total_duration:.3f}s)")
+
+maintenance_jobs = [
+    MaintenanceJob("compact_queues", job_compact_queues, QUEUE_COMPACT_INTERVAL),
+    MaintenanceJob("evict_idle", job_evict_idle, IDLE_EVICT_INTERVAL),
+    MaintenanceJob("expire_fsm", job_expire_fsm, FSM_EXPIRE_INTERVAL),
+    MaintenanceJob("db_housekeeping", job_db_housekeeping, DB_HOUSEKEEPING_INTERVAL, offpeak_only=True),
+]
+
+async def maintenance_loop():
+    logger.info("🧹 Планировщик обслуживания запущен")
+    while True:
+        await asyncio.sleep(MAINTENANCE_TICK_SECONDS)
+        for job in maintenance_jobs:
+            now = time.time()
+            if not job.is_due(now):
+                job.due_since = None
+                continue
+            if job.due_since is None:
+                job.due_since = now
+            # Живой трафик важнее — откладываем до следующего тика, но не дольше MAINTENANCE_MAX_DELAY
+            if is_traffic_live(now) and now - job.due_since < MAINTENANCE_MAX_DELAY:
+                continue
+            await job.run()
+
 # === ЗАПУСК ===
 async def main():
     logger.info("🚀 Запуск демонического датинг-бота...")
     # Опционально: Автоматическая рассылка обновлений при запуске бота
     # await broadcast_update_menu()  # Раскомментируйте, если нужно
-    await dp.start_polling(bot)
+    maintenance_task = asyncio.create_task(maintenance_loop())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        maintenance_task.cancel()
 
 if __name__ == "__main__":
     asyncio.run(main())